@@ -1,252 +1,890 @@
-import os
-import streamlit as st
-from dotenv import load_dotenv
-from crewai import Agent,Task,Crew,Process,LLM
-from crewai_tools import SerperDevTool
-from langchain_google_genai import ChatGoogleGenerativeAI
-
-# Load environment variables
-load_dotenv()
-os.environ["SERPER_API_KEY"] = os.getenv("SERPER_API_KEY")
-os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
-
-# Initialize the search tool
-search_tool = SerperDevTool()
-
-llm = LLM(
-    model='gemini/gemini-2.0-flash',
-    api_key=os.getenv("GOOGLE_API_KEY"),
-    verbose=True
-)
-def create_agents():
-    """Create the specialized nutrition agents."""
-    
-    # Nutrition Researcher
-    nutritionist = Agent(
-        role='Nutrition Specialist',
-        goal='Research and develop personalized nutritional recommendations based on scientific evidence',
-        backstory='''You are a highly qualified nutritionist with expertise in therapeutic diets, 
-                    nutrient interactions, and dietary requirements across different health conditions. 
-                    Your recommendations are always backed by peer-reviewed research.''',
-        tools=[search_tool],
-        llm=llm,
-        verbose=True,
-        memory=True,
-        allow_delegation=True
-    )
-    
-    # Medical Nutrition Specialist
-    medical_specialist = Agent(
-        role='Medical Nutrition Therapist',
-        goal='Analyze medical conditions and provide appropriate dietary modifications',
-        backstory='''With dual training in medicine and nutrition, you specialize in managing 
-                    nutrition-related aspects of various medical conditions. You understand 
-                    medication-food interactions and how to optimize nutrition within medical constraints.''',
-        tools=[search_tool],
-        llm=llm,
-        verbose=True
-    )
-    
-    # Diet Plan Creator
-    diet_planner = Agent(
-        role='Therapeutic Diet Planner',
-        goal='Create detailed, practical and enjoyable meal plans tailored to individual needs',
-        backstory='''You excel at transforming clinical nutrition requirements into delicious, 
-                    practical eating plans. You have extensive knowledge of food preparation, 
-                    nutrient preservation, and food combinations that optimize both health and enjoyment.''',
-        llm=llm,
-        verbose=True
-    )
-    
-    return nutritionist, medical_specialist, diet_planner
-
-def create_tasks(nutritionist, medical_specialist, diet_planner, user_info):
-    """Create tasks for each agent based on user information."""
-    
-    # First task: Research nutrition needs based on demographics
-    demographics_research = Task(
-        description=f'''Research nutritional needs for an individual with the following demographics:
-            - Age: {user_info['age']}
-            - Gender: {user_info['gender']}
-            - Height: {user_info['height']}
-            - Weight: {user_info['weight']}
-            - Activity Level: {user_info['activity_level']}
-            - Goals: {user_info['goals']}
-            
-            Provide detailed nutritional requirements including:
-            1. Caloric needs (basal and adjusted for activity)
-            2. Macronutrient distribution (proteins, carbs, fats)
-            3. Key micronutrients particularly important for this demographic
-            4. Hydration requirements
-            5. Meal timing and frequency recommendations''',
-        agent=nutritionist,
-        expected_output="A comprehensive nutritional profile with scientific rationale"
-    )
-    
-    # Second task: Analyze medical conditions and adjust nutritional recommendations
-    medical_analysis = Task(
-        description=f'''Analyze the following medical conditions and medications, then provide dietary modifications:
-            - Medical Conditions: {user_info['medical_conditions']}
-            - Allergies/Intolerances: {user_info['allergies']}
-            
-            Consider the baseline nutritional profile and provide:
-            1. Specific nutrients to increase or limit based on each condition
-            2. Food-medication interactions to avoid
-            3. Potential nutrient deficiencies associated with these conditions/medications
-            4. Foods that may help manage symptoms or improve outcomes
-            5. Foods to strictly avoid''',
-        agent=medical_specialist,
-        context=[demographics_research],
-        expected_output="A detailed analysis of medical nutrition therapy adjustments"
-    )
-    
-    # Third task: Create the comprehensive diet plan
-    diet_plan = Task(
-        description=f'''Create a detailed, practical diet plan incorporating all information:
-            - Budget Constraints: {user_info['budget']}
-            - location's geography / Local Staples: {user_info['location']}
-
-            Develop a comprehensive nutrition plan that includes:
-            1. Specific foods to eat daily, weekly, and occasionally with portion sizes
-            2. A 7-day meal plan with specific meals and recipes in tabular format
-            3. Meal preparation tips and simple recipes
-            4. Eating out guidelines and suggested restaurant options/orders
-            5. Supplement recommendations if necessary (with scientific justification)
-            5. Hydration schedule and recommended beverages
-            6. How to monitor progress and potential adjustments over time''',
-        agent=diet_planner,
-        context=[demographics_research, medical_analysis],
-        expected_output="A comprehensive, practical, and personalized nutrition plan"
-    )
-    
-    return [demographics_research, medical_analysis, diet_plan]
-
-def create_crew(agents, tasks):
-    """Create the CrewAI crew with the specified agents and tasks."""
-    return Crew(
-        agents=agents,
-        tasks=tasks,
-        process=Process.sequential,
-    )
-
-def run_nutrition_advisor(user_info):
-    """Run the nutrition advisor with the user information."""
-    try:
-        # Create agents
-        nutritionist, medical_specialist, diet_planner = create_agents()
-        
-        # Create tasks
-        tasks = create_tasks(nutritionist, medical_specialist, diet_planner, user_info)
-        
-        # Create crew
-        crew = create_crew([nutritionist, medical_specialist, diet_planner], tasks)
-        
-        # Execute the crew
-        with st.spinner('Our nutrition team is creating your personalized plan. This may take a few minutes...'):
-            result = crew.kickoff()
-        
-        return result
-    except Exception as e:
-        st.error(f"An error occurred: {str(e)}")
-        return None
-
-def app():
-    """Main Streamlit application."""
-    st.set_page_config(page_title="AI Nutrition Advisor", page_icon="🤖", layout="wide")
-    
-    st.title("🤖 AI Nutrition Advisor🥗")
-    st.markdown("""
-    Get a detailed nutrition plan based on your demographics, health conditions, and preferences.
-    Our AI team of nutrition specialists will create a personalized recommendation just for you.
-    """)
-    
-    st.header("Personal Information")
-    col1, col2 = st.columns(2)
-    with col1:
-        age = st.number_input("Age", min_value=1, max_value=120, value=30)
-        gender = st.selectbox("Gender", ["Male", "Female", "Non-binary/Other"])
-        height = st.text_input("Height (e.g., 5'10\" or 178 cm)", "5'10\"")
-        
-    with col2:
-        weight = st.text_input("Weight (e.g., 160 lbs or 73 kg)", "160 lbs")
-        goals = st.multiselect(
-            "Nutrition Goals",
-            ["Weight Loss", "Weight Gain", "Maintenance", "Muscle Building", "Better Energy", 
-                "Improved Athletic Performance", "Disease Management", "General Health"]
-        )
-        activity_level = st.select_slider(
-            "Activity Level",
-            options=["Sedentary", "Lightly Active", "Moderately Active", "Very Active", "Extremely Active"]
-        )
-
-    st.header("Health and Location Information")
-    col1, col2 = st.columns(2)
-    with col1:
-        medical_conditions = st.text_input(
-            "Medical Conditions (separate with commas)",
-            placeholder="E.g., Diabetes Type 2, Hypertension, Hypothyroidism..."
-        )
-        allergies = st.text_input(
-            "Food Allergies/Intolerances (separate with commas)",
-            placeholder="E.g., Lactose, Gluten, Shellfish, Peanuts..."
-        )
-    with col2:
-        location = st.text_input(
-            "Enter your location or region",
-            placeholder="E.g., India,Uttar Pradesh, Noida..."
-        )
-        budget = st.select_slider(
-            "Budget Considerations",
-            options=["Very Limited", "Budget Conscious", "Moderate", "Flexible", "No Constraints"]
-        )
-        
-       
-    
-    # Collect all user information
-    user_info = {
-        "age": age,
-        "gender": gender,
-        "height": height,
-        "weight": weight,
-        "activity_level": activity_level,
-        "goals": ", ".join(goals) if goals else "General health improvement",
-        "medical_conditions": medical_conditions or "None reported",
-        "allergies": allergies or "None reported",
-        "budget": budget,
-        "location": location or "No specific factors"
-    }
-    
-    # Check if API keys are present
-    if not os.getenv("SERPER_API_KEY") or not os.getenv("Google_API_KEY"):
-        st.warning("⚠️ API keys not detected. Please add your SERPER_API_KEY and Google_API_KEY to your .env file.")
-
-    # Create a submission button
-    if st.button("Generate Nutrition Plan"):
-        if not goals:
-            st.error("Please select at least one nutrition goal.")
-            return
-        
-        # Display user information summary
-        with st.expander("Summary of Your Information"):
-            st.json(user_info)
-        
-        # Run the nutrition advisor
-        result = run_nutrition_advisor(user_info)
-        
-        if result:
-            st.success("✅ Your personalized nutrition plan is ready!")
-            st.markdown("## Your Personalized Nutrition Plan")
-            try:
-                st.markdown(result)
-            except Exception as e:
-                st.error(f"Error displaying nutrition plan: {e}")
-            # Add download capability
-            st.download_button(
-                label="Download Nutrition Plan",
-                data=str(result),
-                file_name="my_nutrition_plan.txt",
-                mime="text/markdown"
-            )
-
-if __name__ == "__main__":
+import os
+import time
+import queue
+import asyncio
+import threading
+from string import Template
+import httpx
+import litellm
+import pandas as pd
+import nest_asyncio
+import streamlit as st
+from dotenv import load_dotenv
+from pydantic import BaseModel, Field
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from crewai import Agent,Task,Crew,Process,LLM
+from crewai.tools import BaseTool
+from google import genai
+
+# Streamlit already owns an event loop, so allow nested asyncio.run calls
+nest_asyncio.apply()
+
+# Opt-in staircase streaming: overlap the medical analysis and diet plan
+# steps by drafting the plan against a partial analysis as it streams in
+STAIRCASE = os.getenv("STAIRCASE_STREAMING", "0") == "1"
+STAIRCASE_THRESHOLD = 800  # chars of partial analysis before the draft starts
+
+# Debug features, off by default in production: verbose tracing serializes
+# large step dumps to stdout, memory adds an embedding write per step, and
+# delegation can spawn extra coworker LLM round-trips
+VERBOSE = os.getenv("CREW_VERBOSE", "0") == "1"
+AGENT_MEMORY = os.getenv("CREW_MEMORY", "0") == "1"
+ALLOW_DELEGATION = os.getenv("CREW_DELEGATION", "0") == "1"
+
+# Model tiering: the research and analysis steps are well within the faster,
+# cheaper flash-lite; the long-form synthesis keeps full flash
+FAST_MODEL = 'gemini/gemini-2.0-flash-lite'
+MAIN_MODEL = 'gemini/gemini-2.0-flash'
+AGENT_MODELS = {
+    'nutritionist': FAST_MODEL,
+    'medical_specialist': FAST_MODEL,
+    'diet_planner': MAIN_MODEL,
+}
+
+# Transient API errors worth retrying with backoff instead of failing the run
+RETRYABLE_ERRORS = (
+    litellm.RateLimitError,
+    litellm.InternalServerError,
+    litellm.APIConnectionError,
+    TimeoutError,
+)
+CIRCUIT_BREAKER_LIMIT = 3  # consecutive failed runs before pausing
+CIRCUIT_BREAKER_COOLDOWN = 60  # seconds to refuse new runs after tripping
+
+# Stable agent backstories, hoisted so the direct-call paths (synthesis,
+# staircase, batch) can reuse them alongside the agents
+BACKSTORIES = {
+    'nutritionist': '''You are a highly qualified nutritionist with expertise in therapeutic diets,
+                    nutrient interactions, and dietary requirements across different health conditions.
+                    Your recommendations are always backed by peer-reviewed research.''',
+    'medical_specialist': '''With dual training in medicine and nutrition, you specialize in managing
+                    nutrition-related aspects of various medical conditions. You understand
+                    medication-food interactions and how to optimize nutrition within medical constraints.''',
+    'diet_planner': '''You excel at transforming clinical nutrition requirements into delicious,
+                    practical eating plans. You have extensive knowledge of food preparation,
+                    nutrient preservation, and food combinations that optimize both health and enjoyment.''',
+}
+
+# Task description templates, built once at import and filled per run via
+# Template.substitute instead of rebuilding large f-strings on every click;
+# having them up front also lets the prompt budget be measured before any call
+_DEMOGRAPHICS_TPL = Template('''Research nutritional needs for an individual with the following demographics:
+            - Age: $age
+            - Gender: $gender
+            - Height: $height
+            - Weight: $weight
+            - Activity Level: $activity_level
+            - Goals: $goals
+
+            Provide detailed nutritional requirements including:
+            1. Caloric needs (basal and adjusted for activity)
+            2. Macronutrient distribution (proteins, carbs, fats)
+            3. Key micronutrients particularly important for this demographic
+            4. Hydration requirements
+            5. Meal timing and frequency recommendations''')
+
+_STAPLES_TPL = Template('''Research the local food landscape for the following location:
+            - Location/Region: $location
+            - Budget Constraints: $budget
+
+            Provide a concise overview including:
+            1. Affordable staple foods commonly available in this region
+            2. Typical regional dishes and their main ingredients
+            3. Seasonal produce worth prioritizing
+            4. Common local sources of protein, whole grains, and healthy fats''')
+
+_MEDICAL_TPL = Template('''Analyze the following medical conditions and medications, then provide dietary modifications:
+            - Medical Conditions: $medical_conditions
+            - Allergies/Intolerances: $allergies
+
+            Consider the baseline nutritional profile and provide:
+            1. Specific nutrients to increase or limit based on each condition
+            2. Food-medication interactions to avoid
+            3. Potential nutrient deficiencies associated with these conditions/medications
+            4. Foods that may help manage symptoms or improve outcomes
+            5. Foods to strictly avoid''')
+
+_DIET_PLAN_TPL = Template('''Create a detailed, practical diet plan incorporating all information:
+            - Budget Constraints: $budget
+            - location's geography / Local Staples: $location
+
+            Develop a comprehensive nutrition plan that includes:
+            1. Specific foods to eat daily, weekly, and occasionally with portion sizes
+            2. A 7-day meal plan with specific meals and recipes in tabular format
+            3. Meal preparation tips and simple recipes
+            4. Eating out guidelines and suggested restaurant options/orders
+            5. Supplement recommendations if necessary (with scientific justification)
+            5. Hydration schedule and recommended beverages
+            6. How to monitor progress and potential adjustments over time''')
+
+_TASK_TEMPLATES = (_DEMOGRAPHICS_TPL, _STAPLES_TPL, _MEDICAL_TPL, _DIET_PLAN_TPL)
+
+PROMPT_TOKEN_LIMIT = 8000  # budget for the rendered task descriptions combined
+
+@st.cache_resource
+def _init_env():
+    """Load environment variables once per process instead of on every rerun."""
+    load_dotenv()
+    os.environ["SERPER_API_KEY"] = os.getenv("SERPER_API_KEY")
+    os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
+    return True
+
+_HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=16)
+
+@st.cache_resource
+def _init_litellm_session():
+    """Register a pooled sync HTTP/2 client with litellm once per process.
+
+    Only the sync session is safe to share process-wide: pooled async
+    connections are bound to the event loop that created them, and each
+    pipeline run and tool batch uses its own short-lived loop, so litellm
+    manages its own async clients.
+    """
+    litellm.client_session = httpx.Client(http2=True, limits=_HTTP_LIMITS, timeout=60)
+    return True
+
+class SearchQueries(BaseModel):
+    """Input schema for the batched Serper search tool."""
+    queries: list[str] = Field(..., description="One or more search queries to run in parallel")
+
+class AsyncSerperTool(BaseTool):
+    """Serper search tool that runs a batch of queries concurrently.
+
+    The stock SerperDevTool issues one synchronous HTTP call per query; this
+    variant accepts a list of queries so the agent can batch its lookups into
+    a single concurrent round trip.
+    """
+    name: str = "Search the internet"
+    description: str = ('''Search the internet via Serper. Accepts a list of search
+                        queries and runs them all concurrently, returning the top
+                        results for each query.''')
+    args_schema: type[BaseModel] = SearchQueries
+
+    def _run(self, queries):
+        if isinstance(queries, str):
+            queries = [queries]
+        return asyncio.run(self._search_all(queries))
+
+    async def _search_all(self, queries):
+        headers = {
+            'X-API-KEY': os.getenv("SERPER_API_KEY"),
+            'Content-Type': 'application/json',
+        }
+        # The client must live and die with this batch's event loop; HTTP/2
+        # still multiplexes the whole batch over one connection
+        async with httpx.AsyncClient(http2=True, limits=_HTTP_LIMITS, timeout=60) as client:
+            results = await asyncio.gather(*[self._search(client, headers, query) for query in queries])
+        return '\n\n'.join(results)
+
+    async def _search(self, client, headers, query):
+        response = await client.post('https://google.serper.dev/search', json={'q': query}, headers=headers)
+        if response.status_code != 200:
+            # Surface the failure per query instead of pretending there were
+            # no results (e.g. on an auth error or rate limit)
+            return (f"Search for '{query}' failed: "
+                    f"HTTP {response.status_code} {response.text[:200]}")
+        payload = response.json()
+        organic = payload.get('organic', [])
+        if not organic:
+            return f"Results for '{query}': no results found"
+        lines = [f"Results for '{query}':"]
+        for item in organic[:5]:
+            lines.append(f"- {item.get('title', '')}: {item.get('snippet', '')} ({item.get('link', '')})")
+        return '\n'.join(lines)
+
+@st.cache_resource
+def get_search_tool():
+    """Initialize the search tool once and reuse it across reruns."""
+    _init_env()
+    return AsyncSerperTool()
+
+@st.cache_resource
+def get_genai_client():
+    """Create the google-genai client once and reuse it across reruns."""
+    _init_env()
+    return genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+
+@st.cache_resource
+def get_llm(model=MAIN_MODEL):
+    """Initialize an LLM wrapper once per model and reuse it across reruns."""
+    _init_env()
+    _init_litellm_session()  # register the pooled sync session with litellm up front
+    return LLM(
+        model=model,
+        api_key=os.getenv("GOOGLE_API_KEY"),
+        verbose=VERBOSE,
+        stream=True
+    )
+
+def _estimate_tokens(text):
+    """Count prompt tokens via the Gemini API, falling back to chars/4."""
+    try:
+        counted = get_genai_client().models.count_tokens(
+            model=MAIN_MODEL.removeprefix('gemini/'), contents=text)
+        return counted.total_tokens
+    except Exception:
+        return len(text) // 4
+
+def _trim_user_info(user_info):
+    """Cap free-text fields if the rendered prompts would blow the token budget.
+
+    Measuring up front avoids a costly context-window-exceeded failure and
+    retry round trip. Only the unbounded user-supplied fields are shortened;
+    the structured inputs are left untouched.
+    """
+    trimmed = dict(user_info)
+    free_text_fields = ('medical_conditions', 'allergies', 'location', 'goals')
+
+    def _rendered(info):
+        return '\n'.join(tpl.substitute(info) for tpl in _TASK_TEMPLATES)
+
+    while _estimate_tokens(_rendered(trimmed)) > PROMPT_TOKEN_LIMIT:
+        longest = max(free_text_fields, key=lambda field: len(str(trimmed[field])))
+        value = str(trimmed[longest])
+        if len(value) <= 200:
+            break
+        trimmed[longest] = value[:len(value) // 2] + '...'
+    return trimmed
+
+def _chunk_text(output):
+    """Pull display text out of a CrewAI step/task callback payload."""
+    for attr in ('raw', 'output', 'result'):
+        value = getattr(output, attr, None)
+        if value:
+            return str(value)
+    return str(output)
+
+def create_nutritionist(step_callback=None):
+    """Create a nutrition researcher agent; each concurrent crew needs its own."""
+    return Agent(
+        role='Nutrition Specialist',
+        goal='Research and develop personalized nutritional recommendations based on scientific evidence',
+        backstory=BACKSTORIES['nutritionist'],
+        tools=[get_search_tool()],
+        llm=get_llm(AGENT_MODELS['nutritionist']),
+        step_callback=step_callback,
+        verbose=VERBOSE,
+        memory=AGENT_MEMORY,
+        allow_delegation=ALLOW_DELEGATION
+    )
+
+def create_agents(step_callback=None):
+    """Create the specialized nutrition agents for one run.
+
+    Agents are cheap pydantic objects; the heavyweight LLM, search tool, and
+    cache resources behind them stay cached per process. Building the agents
+    per run binds streaming callbacks at construction, so concurrent sessions
+    never share callback state.
+    """
+    search_tool = get_search_tool()
+
+    # Nutrition Researcher
+    nutritionist = create_nutritionist(step_callback)
+
+    # Medical Nutrition Specialist
+    medical_specialist = Agent(
+        role='Medical Nutrition Therapist',
+        goal='Analyze medical conditions and provide appropriate dietary modifications',
+        backstory=BACKSTORIES['medical_specialist'],
+        tools=[search_tool],
+        llm=get_llm(AGENT_MODELS['medical_specialist']),
+        step_callback=step_callback,
+        verbose=VERBOSE
+    )
+
+    # Diet Plan Creator
+    diet_planner = Agent(
+        role='Therapeutic Diet Planner',
+        goal='Create detailed, practical and enjoyable meal plans tailored to individual needs',
+        backstory=BACKSTORIES['diet_planner'],
+        llm=get_llm(AGENT_MODELS['diet_planner']),
+        step_callback=step_callback,
+        verbose=VERBOSE
+    )
+    
+    return nutritionist, medical_specialist, diet_planner
+
+class Macros(BaseModel):
+    """Daily macronutrient targets in grams."""
+    protein_g: int
+    carbs_g: int
+    fat_g: int
+
+class Micronutrient(BaseModel):
+    """A key micronutrient and why it matters for this individual."""
+    name: str
+    daily_target: str
+    rationale: str
+
+class NutritionProfile(BaseModel):
+    """Structured output of the demographics research task."""
+    calories_kcal: int
+    macros: Macros
+    micronutrients: list[Micronutrient]
+    hydration_liters: float
+    meal_timing: str
+
+class DietaryAdjustment(BaseModel):
+    """One condition-driven dietary modification."""
+    nutrient_or_food: str
+    action: str
+    reason: str
+
+class MedicalAdjustments(BaseModel):
+    """Structured output of the medical analysis task."""
+    adjustments: list[DietaryAdjustment]
+    medication_interactions: list[str]
+    deficiency_risks: list[str]
+    helpful_foods: list[str]
+    foods_to_avoid: list[str]
+
+def create_research_tasks(nutritionist, staples_researcher, user_info):
+    """Create the independent research tasks that can run concurrently.
+
+    The two tasks execute in concurrent crews, so each gets its own agent
+    instance rather than sharing one.
+    """
+
+    # Research nutrition needs based on demographics
+    demographics_research = Task(
+        description=_DEMOGRAPHICS_TPL.substitute(user_info),
+        agent=nutritionist,
+        expected_output="A comprehensive nutritional profile with scientific rationale",
+        output_pydantic=NutritionProfile
+    )
+
+    # Research local staple foods; this only needs the location, so it can
+    # overlap with the demographics research instead of waiting behind it
+    location_staples_research = Task(
+        description=_STAPLES_TPL.substitute(user_info),
+        agent=staples_researcher,
+        expected_output="A summary of affordable local staples and regional dishes"
+    )
+
+    return demographics_research, location_staples_research
+
+def create_plan_tasks(medical_specialist, diet_planner, user_info, demographics_research, location_staples_research):
+    """Create the dependent tasks that build on the research results."""
+
+    # Analyze medical conditions and adjust nutritional recommendations
+    medical_analysis = Task(
+        description=_MEDICAL_TPL.substitute(user_info),
+        agent=medical_specialist,
+        context=[demographics_research],
+        expected_output="A detailed analysis of medical nutrition therapy adjustments",
+        output_pydantic=MedicalAdjustments
+    )
+
+    # Create the comprehensive diet plan
+    diet_plan = Task(
+        description=_DIET_PLAN_TPL.substitute(user_info),
+        agent=diet_planner,
+        context=[demographics_research, medical_analysis, location_staples_research],
+        expected_output="A comprehensive, practical, and personalized nutrition plan"
+    )
+
+    return medical_analysis, diet_plan
+
+def create_crew(agents, tasks, task_callback=None):
+    """Create the CrewAI crew with the specified agents and tasks."""
+    return Crew(
+        agents=agents,
+        tasks=tasks,
+        process=Process.sequential,
+        task_callback=task_callback,
+    )
+
+async def _stream_completion(messages, on_token=None, model=MAIN_MODEL):
+    """Stream a single Gemini completion via litellm and return the full text."""
+    response = await litellm.acompletion(
+        model=model,
+        messages=messages,
+        api_key=os.getenv("GOOGLE_API_KEY"),
+        stream=True,
+    )
+    chunks = []
+    async for part in response:
+        delta = part.choices[0].delta.content or ''
+        if delta:
+            chunks.append(delta)
+            if on_token:
+                on_token(delta)
+    return ''.join(chunks)
+
+async def _staircase_phase2(medical_analysis, diet_plan, research_notes, on_chunk=None):
+    """Overlap the medical analysis and diet plan steps via staircase streaming.
+
+    The diet plan normally waits for the complete medical analysis. Here the
+    planner starts drafting as soon as enough of the analysis has streamed in,
+    then revises the draft once the full analysis is available, so the two
+    generations overlap instead of running back to back.
+    """
+    partial = []
+    draft_future = None
+
+    async def _start_draft():
+        return await _stream_completion([{'role': 'user', 'content': (
+            f"{diet_plan.description}\n\n"
+            f"Research so far:\n{research_notes}\n\n"
+            f"Partial medical nutrition analysis (more may follow):\n{''.join(partial)}\n\n"
+            "Draft the nutrition plan from this information."
+        )}])
+
+    def _on_token(token):
+        nonlocal draft_future
+        partial.append(token)
+        if draft_future is None and sum(len(p) for p in partial) >= STAIRCASE_THRESHOLD:
+            draft_future = asyncio.ensure_future(_start_draft())
+
+    # Step 2: stream the medical analysis, kicking off the draft mid-stream
+    analysis = await _stream_completion(
+        [{'role': 'user', 'content': f"{medical_analysis.description}\n\nResearch so far:\n{research_notes}"}],
+        _on_token,
+        model=FAST_MODEL
+    )
+    if on_chunk:
+        on_chunk(analysis)
+
+    if draft_future is None:
+        draft_future = asyncio.ensure_future(_start_draft())
+    draft = await draft_future
+
+    # Step 3 (final pass): revise the draft against the complete analysis
+    return await _stream_completion([{'role': 'user', 'content': (
+        f"{diet_plan.description}\n\n"
+        f"Complete medical nutrition analysis:\n{analysis}\n\n"
+        f"Draft plan produced from a partial analysis:\n{draft}\n\n"
+        "Revise the draft into the final plan, correcting anything the "
+        "complete analysis changes."
+    )}], on_chunk)
+
+# Default checkpoint store for callers without a Streamlit session,
+# e.g. the FastAPI server in server.py. Streamlit callers read their
+# session-scoped store on the script thread and pass it in explicitly,
+# since st.session_state accessed from a worker thread silently returns
+# a fresh throwaway state instead of the session's.
+_PROCESS_CHECKPOINTS = {}
+
+async def _with_retries(step):
+    """Run one pipeline step with bounded exponential-backoff retries."""
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(4),
+        wait=wait_exponential_jitter(initial=1, max=10),
+        retry=retry_if_exception_type(RETRYABLE_ERRORS),
+        reraise=True,
+    ):
+        with attempt:
+            return await step()
+
+async def _synthesize_plan(diet_plan, context_notes, on_chunk=None):
+    """Generate the final diet plan with a direct streaming Gemini call.
+
+    The synthesis step uses no tools, so the agent-framework and litellm
+    adapter layers are pure overhead; call the google-genai client directly
+    and stream the plan as it generates.
+    """
+    context = '\n\n'.join(notes for notes in context_notes if notes)
+    prompt = (
+        f"{BACKSTORIES['diet_planner']}\n\n"
+        f"{diet_plan.description}\n\n"
+        f"Context from the nutrition team:\n{context}"
+    )
+    client = get_genai_client()
+    chunks = []
+    async for part in await client.aio.models.generate_content_stream(
+        model=MAIN_MODEL.removeprefix('gemini/'),
+        contents=prompt,
+    ):
+        text = part.text or ''
+        if text:
+            chunks.append(text)
+            if on_chunk:
+                on_chunk(text)
+    return ''.join(chunks)
+
+async def _run_pipeline(user_info, on_chunk=None, checkpoints=None):
+    """Run the research tasks concurrently, then the dependent planning tasks."""
+    user_info = _trim_user_info(user_info)
+    step_callback = None
+    task_callback = None
+    if on_chunk:
+        step_callback = lambda output: on_chunk(_chunk_text(output) + '\n\n')
+        task_callback = lambda output: on_chunk(_chunk_text(output) + '\n\n')
+
+    # Agents are built per run so the streaming callbacks are bound at
+    # construction instead of mutating shared state
+    nutritionist, medical_specialist, diet_planner = create_agents(step_callback)
+    staples_researcher = create_nutritionist(step_callback)
+
+    # Completed step outputs survive a failed run, so a retry after a
+    # transient error resumes from the failed step instead of starting over
+    completed = checkpoints if checkpoints is not None else _PROCESS_CHECKPOINTS
+    run_key = str(tuple(sorted(user_info.items())))
+
+    # Phase 1: independent research tasks run concurrently
+    demographics_research, location_staples_research = create_research_tasks(
+        nutritionist, staples_researcher, user_info)
+    if (run_key, 'research') in completed:
+        demographics_notes, staples_notes = completed[(run_key, 'research')]
+    else:
+        research_crews = [
+            create_crew([nutritionist], [demographics_research], task_callback),
+            create_crew([staples_researcher], [location_staples_research], task_callback),
+        ]
+        await asyncio.gather(*[_with_retries(crew.kickoff_async) for crew in research_crews])
+        demographics_notes = _chunk_text(demographics_research.output)
+        staples_notes = _chunk_text(location_staples_research.output)
+        completed[(run_key, 'research')] = (demographics_notes, staples_notes)
+
+    # Phase 2: dependent tasks build on the research context
+    medical_analysis, diet_plan = create_plan_tasks(
+        medical_specialist, diet_planner, user_info,
+        demographics_research, location_staples_research
+    )
+    if STAIRCASE:
+        research_notes = f"{demographics_notes}\n\n{staples_notes}"
+        result = await _staircase_phase2(medical_analysis, diet_plan, research_notes, on_chunk)
+        completed.pop((run_key, 'research'), None)
+        return result
+
+    if (run_key, 'medical') in completed:
+        analysis_notes = completed[(run_key, 'medical')]
+    else:
+        if demographics_research.output is None:
+            # Resumed run: the research tasks were skipped, so their notes
+            # are inlined instead of flowing through the task context
+            medical_analysis.description += f"\n\nBaseline nutritional profile:\n{demographics_notes}"
+            medical_analysis.context = []
+        plan_crew = create_crew([medical_specialist], [medical_analysis], task_callback)
+        await _with_retries(plan_crew.kickoff_async)
+        analysis_notes = _chunk_text(medical_analysis.output)
+        completed[(run_key, 'medical')] = analysis_notes
+
+    # The final synthesis uses no tools, so it bypasses the crew entirely
+    result = await _with_retries(lambda: _synthesize_plan(
+        diet_plan,
+        [demographics_notes, staples_notes, analysis_notes],
+        on_chunk
+    ))
+
+    # The run finished, so its resume checkpoints are no longer needed
+    completed.pop((run_key, 'research'), None)
+    completed.pop((run_key, 'medical'), None)
+    return result
+
+def _submit_batch_plan(user_info):
+    """Submit the plan request through Gemini's discounted batch endpoint.
+
+    Batch inference trades latency (typically minutes up to an hour) for
+    roughly half the cost and keeps traffic off the interactive quota. Batch
+    jobs cannot feed one step's output into the next, so the chained task
+    prompts are collapsed into one combined request.
+    """
+    user_info = _trim_user_info(user_info)
+    prompt = '\n\n'.join([
+        BACKSTORIES['diet_planner'],
+        _DEMOGRAPHICS_TPL.substitute(user_info),
+        _MEDICAL_TPL.substitute(user_info),
+        _DIET_PLAN_TPL.substitute(user_info),
+    ])
+    client = get_genai_client()
+    job = client.batches.create(
+        model=MAIN_MODEL.removeprefix('gemini/'),
+        src=[{'contents': [{'role': 'user', 'parts': [{'text': prompt}]}]}],
+        config={'display_name': 'nutrition-plan-batch'},
+    )
+    return job.name
+
+# Terminal batch states that will never produce a plan
+BATCH_FAILURE_STATES = ('JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED')
+
+def _poll_batch_plan(job_name):
+    """Check a submitted batch job; returns (state, plan text, error).
+
+    Exactly one of plan and error is set once the job reaches a terminal
+    state; both are None while the job is still in flight.
+    """
+    client = get_genai_client()
+    job = client.batches.get(name=job_name)
+    state = getattr(job.state, 'name', str(job.state))
+    if state in BATCH_FAILURE_STATES:
+        error = getattr(job, 'error', None)
+        return state, None, str(error) if error else state
+    if state != 'JOB_STATE_SUCCEEDED':
+        return state, None, None
+    response = job.dest.inlined_responses[0].response
+    return state, response.text, None
+
+def run_nutrition_advisor(user_info, placeholder=None):
+    """Run the nutrition advisor, streaming intermediate output into the placeholder.
+
+    Failures raise instead of returning None, so the result cache only ever
+    memoizes successful runs.
+    """
+    # Circuit breaker: after repeated consecutive failures the APIs are
+    # likely rate limited, so refuse new runs until the cooldown expires
+    remaining = st.session_state.get('breaker_until', 0) - time.time()
+    if remaining > 0:
+        raise RuntimeError("Several runs in a row have failed; the APIs may be "
+                           f"rate limited. Try again in {int(remaining) + 1} seconds.")
+    try:
+        if placeholder is not None:
+            placeholder.markdown('_Our nutrition team is working on your plan..._')
+
+        # The crew executes on worker threads, so callbacks fire without a
+        # Streamlit script-run context and cannot touch widgets directly.
+        # Chunks are handed through a thread-safe queue and the placeholder
+        # is updated here on the script thread.
+        chunk_queue = queue.Queue()
+        outcome = {}
+
+        # The session's checkpoint store must be read here on the script
+        # thread: st.session_state on the worker thread would silently
+        # return an empty throwaway state and resume would never fire
+        checkpoints = st.session_state.setdefault('completed_steps', {})
+
+        def _worker():
+            try:
+                outcome['result'] = asyncio.run(
+                    _run_pipeline(user_info, chunk_queue.put, checkpoints))
+            except Exception as exc:
+                outcome['error'] = exc
+            finally:
+                chunk_queue.put(None)
+
+        worker = threading.Thread(target=_worker, daemon=True)
+        worker.start()
+
+        buffer = ''
+        while True:
+            chunk = chunk_queue.get()
+            if chunk is None:
+                break
+            buffer += chunk
+            if placeholder is not None:
+                placeholder.markdown(buffer)
+        worker.join()
+
+        if 'error' in outcome:
+            raise outcome['error']
+
+        st.session_state['pipeline_failures'] = 0
+        st.session_state['breaker_until'] = 0
+        return outcome['result']
+    except Exception:
+        failures = st.session_state.get('pipeline_failures', 0) + 1
+        st.session_state['pipeline_failures'] = failures
+        if failures >= CIRCUIT_BREAKER_LIMIT:
+            st.session_state['breaker_until'] = time.time() + CIRCUIT_BREAKER_COOLDOWN
+        raise
+
+def _render_plan(plan_md):
+    """Render the plan, showing markdown tables as virtualized dataframes.
+
+    Long plans include the 7-day meal plan as a large markdown table, which
+    the markdown renderer re-parses on every rerun; st.dataframe rendering is
+    virtualized and much cheaper. Malformed tables fall back to markdown.
+    """
+    text_lines = []
+    table_lines = []
+
+    def _flush_text():
+        if text_lines:
+            st.markdown('\n'.join(text_lines))
+            text_lines.clear()
+
+    def _flush_table():
+        # header row + separator row + at least one data row
+        if len(table_lines) >= 3:
+            header = [cell.strip() for cell in table_lines[0].strip().strip('|').split('|')]
+            rows = [
+                [cell.strip() for cell in line.strip().strip('|').split('|')]
+                for line in table_lines[2:]
+            ]
+            rows = [row for row in rows if len(row) == len(header)]
+            if rows:
+                _flush_text()
+                st.dataframe(pd.DataFrame(rows, columns=header), use_container_width=True)
+            else:
+                text_lines.extend(table_lines)
+        else:
+            text_lines.extend(table_lines)
+        table_lines.clear()
+
+    for line in plan_md.split('\n'):
+        if line.lstrip().startswith('|'):
+            table_lines.append(line)
+        else:
+            _flush_table()
+            text_lines.append(line)
+    _flush_table()
+    _flush_text()
+
+@st.cache_resource
+def _api_keys_ok():
+    """Check the required API keys once per process instead of on every rerun."""
+    _init_env()
+    return bool(os.getenv("SERPER_API_KEY") and os.getenv("GOOGLE_API_KEY"))
+
+@st.cache_data(show_spinner=False, ttl=24 * 3600)
+def _cached_run(user_info_frozen, nonce, _placeholder):
+    """Replay the prior result for identical inputs instead of redoing the LLM chain.
+
+    The nonce lets the "Force regenerate" option bust the cache. Failures
+    raise out of here, so they are never memoized for these inputs.
+    """
+    result = run_nutrition_advisor(dict(user_info_frozen), _placeholder)
+    return str(result)
+
+def app():
+    """Main Streamlit application."""
+    st.set_page_config(page_title="AI Nutrition Advisor", page_icon="🤖", layout="wide")
+    _init_env()
+
+    st.title("🤖 AI Nutrition Advisor🥗")
+    st.markdown("""
+    Get a detailed nutrition plan based on your demographics, health conditions, and preferences.
+    Our AI team of nutrition specialists will create a personalized recommendation just for you.
+    """)
+    
+    # Batch all inputs into one rerun on submit instead of rerunning per keystroke
+    with st.form("nutrition_form"):
+        st.header("Personal Information")
+        col1, col2 = st.columns(2)
+        with col1:
+            age = st.number_input("Age", min_value=1, max_value=120, value=30)
+            gender = st.selectbox("Gender", ["Male", "Female", "Non-binary/Other"])
+            height = st.text_input("Height (e.g., 5'10\" or 178 cm)", "5'10\"")
+        
+        with col2:
+            weight = st.text_input("Weight (e.g., 160 lbs or 73 kg)", "160 lbs")
+            goals = st.multiselect(
+                "Nutrition Goals",
+                ["Weight Loss", "Weight Gain", "Maintenance", "Muscle Building", "Better Energy", 
+                    "Improved Athletic Performance", "Disease Management", "General Health"]
+            )
+            activity_level = st.select_slider(
+                "Activity Level",
+                options=["Sedentary", "Lightly Active", "Moderately Active", "Very Active", "Extremely Active"]
+            )
+
+        st.header("Health and Location Information")
+        col1, col2 = st.columns(2)
+        with col1:
+            medical_conditions = st.text_input(
+                "Medical Conditions (separate with commas)",
+                placeholder="E.g., Diabetes Type 2, Hypertension, Hypothyroidism..."
+            )
+            allergies = st.text_input(
+                "Food Allergies/Intolerances (separate with commas)",
+                placeholder="E.g., Lactose, Gluten, Shellfish, Peanuts..."
+            )
+        with col2:
+            location = st.text_input(
+                "Enter your location or region",
+                placeholder="E.g., India,Uttar Pradesh, Noida..."
+            )
+            budget = st.select_slider(
+                "Budget Considerations",
+                options=["Very Limited", "Budget Conscious", "Moderate", "Flexible", "No Constraints"]
+            )
+            force_regenerate = st.checkbox(
+                "Force regenerate",
+                help="Rerun the full pipeline even if an identical request was generated recently."
+            )
+
+        submitted = st.form_submit_button("Generate Nutrition Plan")
+        batch_submitted = st.form_submit_button("Generate (batch, cheaper)")
+
+    # Collect all user information
+    user_info = {
+        "age": age,
+        "gender": gender,
+        "height": height,
+        "weight": weight,
+        "activity_level": activity_level,
+        "goals": ", ".join(goals) if goals else "General health improvement",
+        "medical_conditions": medical_conditions or "None reported",
+        "allergies": allergies or "None reported",
+        "budget": budget,
+        "location": location or "No specific factors"
+    }
+    
+    # Check if API keys are present
+    if not _api_keys_ok():
+        st.warning("⚠️ API keys not detected. Please add your SERPER_API_KEY and GOOGLE_API_KEY to your .env file.")
+
+    if (submitted or batch_submitted) and not goals:
+        st.error("Please select at least one nutrition goal.")
+        return
+
+    # Cheaper, slower path: submit the request as an offline batch job
+    if batch_submitted:
+        try:
+            st.session_state['batch_job'] = _submit_batch_plan(user_info)
+            st.info("Batch job submitted. Check back below — plans typically arrive within an hour.")
+        except Exception as e:
+            st.error(f"Could not submit batch job: {str(e)}")
+
+    if st.session_state.get('batch_job'):
+        if st.button("Check batch status"):
+            try:
+                state, plan, error = _poll_batch_plan(st.session_state['batch_job'])
+            except Exception as e:
+                st.error(f"Could not check batch job: {str(e)}")
+            else:
+                if plan:
+                    st.session_state['plan_md'] = plan
+                    st.session_state['plan_bytes'] = plan.encode('utf-8')
+                    del st.session_state['batch_job']
+                    st.success("✅ Your batch-generated nutrition plan is ready!")
+                elif error:
+                    # The job will never finish, so drop it and let the
+                    # user submit a fresh one
+                    del st.session_state['batch_job']
+                    st.error(f"Batch job failed ({state}): {error}. Please submit a new batch request.")
+                else:
+                    st.info(f"Batch job is still running (state: {state}).")
+
+    # Run once the form is submitted
+    if submitted:
+        
+        # Display user information summary
+        with st.expander("Summary of Your Information"):
+            st.json(user_info)
+        
+        # Run the nutrition advisor, streaming progress into a live placeholder;
+        # identical inputs replay the cached result instantly
+        placeholder = st.empty()
+        user_info_frozen = tuple(sorted(user_info.items()))
+        nonce = time.time_ns() if force_regenerate else 0
+        try:
+            result = _cached_run(user_info_frozen, nonce, placeholder)
+        except Exception as e:
+            result = None
+            st.error(f"An error occurred: {str(e)}")
+
+        if result:
+            placeholder.empty()
+            # Persist the plan so later reruns render it without regenerating
+            st.session_state['plan_md'] = str(result)
+            st.session_state['plan_bytes'] = st.session_state['plan_md'].encode('utf-8')
+            st.success("✅ Your personalized nutrition plan is ready!")
+
+    # Render the stored plan on every rerun (e.g. after a download click)
+    if st.session_state.get('plan_md'):
+        st.markdown("## Your Personalized Nutrition Plan")
+        try:
+            _render_plan(st.session_state['plan_md'])
+        except Exception as e:
+            st.error(f"Error displaying nutrition plan: {e}")
+        # Add download capability
+        st.download_button(
+            label="Download Nutrition Plan",
+            data=st.session_state['plan_bytes'],
+            file_name="my_nutrition_plan.md",
+            mime="text/markdown"
+        )
+
+if __name__ == "__main__":
     app()
\ No newline at end of file
@@ -0,0 +1,69 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+
+from app import create_agents, _run_pipeline
+
+@asynccontextmanager
+async def lifespan(api):
+    """Warm the shared LLM, tool, and client caches once at startup.
+
+    Agents themselves are built per request so streaming callbacks are never
+    shared across sockets.
+    """
+    create_agents()
+    yield
+
+api = FastAPI(title="AI Nutrition Advisor", lifespan=lifespan)
+
+@api.websocket("/plan")
+async def plan(ws: WebSocket):
+    """Stream a nutrition plan over a WebSocket.
+
+    The client sends the user_info dict as JSON; pipeline output is pushed
+    back chunk by chunk as it is generated, followed by a final message with
+    the complete plan.
+    """
+    await ws.accept()
+    try:
+        user_info = await ws.receive_json()
+
+        # The pipeline emits chunks from crew worker threads and
+        # asyncio.Queue is not thread-safe, so chunks are handed to the loop
+        # thread explicitly before a sender task pushes them to the socket
+        loop = asyncio.get_running_loop()
+        chunk_queue = asyncio.Queue()
+
+        def _on_chunk(chunk):
+            loop.call_soon_threadsafe(chunk_queue.put_nowait, chunk)
+
+        async def _sender():
+            while True:
+                chunk = await chunk_queue.get()
+                if chunk is None:
+                    break
+                await ws.send_text(chunk)
+
+        sender = asyncio.create_task(_sender())
+        error = None
+        try:
+            result = await _run_pipeline(user_info, on_chunk=_on_chunk)
+        except Exception as exc:
+            error = exc
+        finally:
+            _on_chunk(None)
+            await sender
+
+        # Report failures to the client instead of dropping the socket
+        if error is None:
+            await ws.send_json({"event": "done", "plan": str(result)})
+        else:
+            await ws.send_json({"event": "error", "detail": str(error)})
+        await ws.close()
+    except WebSocketDisconnect:
+        pass
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(api, host="0.0.0.0", port=8000)